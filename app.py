@@ -1,16 +1,29 @@
-import json
+import asyncio
+from collections import defaultdict
+from contextlib import asynccontextmanager
 from math import ceil
-from typing import List
-from fastapi import Depends, FastAPI, Query, Request, HTTPException
+from typing import Dict, List, Optional, Tuple
+from fastapi import BackgroundTasks, Depends, FastAPI, Query, Request, HTTPException
+from fastapi.responses import ORJSONResponse
+from fastapi_cache import FastAPICache
+from fastapi_cache.backends.inmemory import InMemoryBackend, Value
+from fastapi_cache.decorator import cache
 from fastapi_swagger import patch_fastapi
 from loguru import logger
-import hashlib
 import hmac
+import orjson
 
 import uvicorn
-from models import get_session,Session,Repository,Author,Asset,Release, save_releases_to_db
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload, selectinload
+from config import settings
+from models import get_async_session,Repository,Author,Asset,Release, save_releases_to_db
 from res_model import *
 
+# webhook密钥只编码一次，避免每次请求重复encode
+_SECRET = settings.webhook_token.encode('utf-8')
+
 def verify_signature(payload_body, secret_token, signature_header):
     """Verify that the payload was sent from GitHub by validating SHA256.
 
@@ -18,41 +31,112 @@ def verify_signature(payload_body, secret_token, signature_header):
 
     Args:
         payload_body: original request body to verify (request.body())
-        secret_token: GitHub app webhook token (WEBHOOK_SECRET)
+        secret_token: GitHub app webhook token as bytes (_SECRET)
         signature_header: header received from GitHub (x-hub-signature-256)
     """
     if not signature_header:
         raise HTTPException(status_code=403, detail="x-hub-signature-256 header is missing!")
-    hash_object = hmac.new(secret_token.encode('utf-8'), msg=payload_body, digestmod=hashlib.sha256)
-    expected_signature = "sha256=" + hash_object.hexdigest()
-    if not hmac.compare_digest(expected_signature, signature_header):
+    if not signature_header.startswith("sha256="):
+        raise HTTPException(status_code=403, detail="Request signatures didn't match!")
+    try:
+        provided = bytes.fromhex(signature_header[7:])
+    except ValueError:
+        raise HTTPException(status_code=403, detail="Request signatures didn't match!")
+    mac = hmac.digest(secret_token, payload_body, 'sha256')
+    if not hmac.compare_digest(mac, provided):
         raise HTTPException(status_code=403, detail="Request signatures didn't match!")
 
 
 
-app = FastAPI()
+def params_key_builder(func, namespace: str = "", *, request: Request = None, response=None, args=(), kwargs=None):
+    # 以校验后的接口参数作为缓存键：去掉每次请求都不同的数据库会话，
+    # 参数顺序及未声明的查询参数也不会产生新的键
+    params = sorted((name, value) for name, value in kwargs.items() if name != "db")
+    return f"{namespace}:{func.__name__}:{params}"
+
+
+class BoundedInMemoryBackend(InMemoryBackend):
+    """
+    限制条目数量的内存缓存：写入时清理过期键，超出上限时淘汰最早写入的键
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        self._store = {}
+        self._max_entries = max_entries
+
+    async def set(self, key: str, value: bytes, expire: Optional[int] = None) -> None:
+        async with self._lock:
+            now = self._now
+            for expired in [k for k, v in self._store.items() if v.ttl_ts < now]:
+                del self._store[expired]
+            self._store.pop(key, None)
+            while len(self._store) >= self._max_entries:
+                del self._store[next(iter(self._store))]
+            self._store[key] = Value(value, now + (expire or 0))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 读接口的数据只在webhook写库后变化，使用内存缓存减少数据库查询
+    FastAPICache.init(BoundedInMemoryBackend(), prefix="spw-cache", key_builder=params_key_builder)
+    yield
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 patch_fastapi(app)
 
+# plugin.json内容只在webhook更新时变化，按仓库缓存解析结果，以plugin_version判断是否失效；
+# 每个仓库只保留最新版本的一份解析结果
+_plugin_cache: Dict[int, Tuple[int, dict]] = {}
+
+def _parse_plugin(repo: Repository) -> dict:
+    cached = _plugin_cache.get(repo.id)
+    if cached is not None and cached[0] == repo.plugin_version:
+        return cached[1]
+    plugin = orjson.loads(repo.plugin)
+    _plugin_cache[repo.id] = (repo.plugin_version, plugin)
+    return plugin
+
 # 依赖函数，用于获取数据库会话
-def get_db():
-    db = get_session()
-    try:
+async def get_db():
+    async with get_async_session() as db:
         yield db
+
+# 同一仓库的写库任务串行执行，避免并发webhook互相覆盖；
+# 记录每个锁的使用者数量，最后一个使用者结束后移除，避免字典无限增长
+_repo_locks: Dict[str, asyncio.Lock] = {}
+_repo_lock_users: Dict[str, int] = defaultdict(int)
+
+async def save_releases_task(repo_owner: str, repo_name: str, releases_data: list):
+    full_name = f"{repo_owner}/{repo_name}"
+    lock = _repo_locks.setdefault(full_name, asyncio.Lock())
+    _repo_lock_users[full_name] += 1
+    try:
+        async with lock:
+            # 同步写库及GitHub请求放到线程中执行，避免阻塞事件循环
+            await asyncio.to_thread(save_releases_to_db, repo_owner, repo_name, releases_data)
     finally:
-        db.close()
+        _repo_lock_users[full_name] -= 1
+        if not _repo_lock_users[full_name]:
+            del _repo_lock_users[full_name]
+            del _repo_locks[full_name]
+    await FastAPICache.clear()
 
 @app.post("/webhook")
-async def github_webhook(request: Request):
-    # 验证请求来源 (可选)
+async def github_webhook(request: Request, background_tasks: BackgroundTasks):
+    # 先在原始请求体上验证签名，再解析内容
+    body = await request.body()
+    verify_signature(body, _SECRET, request.headers.get("x-hub-signature-256"))
     event = request.headers.get("X-GitHub-Event")
     logger.info(f"Received event: {event}")
     if event != "release":
         return "skip"
-    payload = await request.json()
+    payload = orjson.loads(body)
     raw = payload["repository"]["full_name"].split("/",1)
-    save_releases_to_db( raw[0],raw[1],payload["release"])
-    return "success"
+    # 写库耗时较长，放到后台执行以便及时响应GitHub
+    background_tasks.add_task(save_releases_task, raw[0], raw[1], [payload["release"]])
+    return ORJSONResponse("success", status_code=202)
 
 
 @app.get("/")
@@ -62,27 +146,39 @@ async def health_check():
 
 
 @app.get("/repositories", response_model=PaginatedResponse[RepositoryBasicModel], tags=["Repositories"]) 
+@cache(expire=60)
 async def get_repositories(
     page: int = Query(1, ge=1, description="页码（从1开始）"),
     limit: int = Query(10, ge=1, le=1000, description="每页条数"),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """
     分页获取仓库的基本信息列表
     """
-    total = db.query(Repository).count()
+    total = await db.scalar(select(func.count()).select_from(Repository))
     skip = (page - 1) * limit
     pages = ceil(total / limit) if total else 1
-    repositories = db.query(Repository).offset(skip).limit(limit).all()
+    result = await db.execute(select(Repository).offset(skip).limit(limit))
+    repositories = result.scalars().all()
+
+    # 一次查询取出当前页所有仓库的tag_name，只投影所需列而不构造Release对象，避免逐个仓库查询(N+1)
+    tag_names = defaultdict(list)
+    if repositories:
+        result = await db.execute(
+            select(Release.repository_id, Release.tag_name)
+            .where(Release.repository_id.in_([repo.id for repo in repositories]))
+            .order_by(Release.repository_id, Release.id)
+        )
+        for repository_id, tag_name in result:
+            tag_names[repository_id].append(tag_name)
 
     items = []
     for repo in repositories: 
-        releases = [t for t, in db.query(Release).filter(Release.repository_id == repo.id).values(Release.tag_name)]
-        print(releases)
+        releases = tag_names[repo.id]
         repo_model = RepositoryBasicModel(
             id=repo.id,
             name=repo.name,
-            plugin=json.loads(repo.plugin),
+            plugin=_parse_plugin(repo),
             full_name=repo.full_name,
             html_url=repo.html_url,
             releases=releases, 
@@ -98,98 +194,124 @@ async def get_repositories(
     )
 
 @app.get("/repositories/{repo_id}", response_model=RepositoryModel, tags=["Repositories"])
-async def get_repository(repo_id: int, db: Session = Depends(get_db)):
+@cache(expire=60)
+async def get_repository(repo_id: int, db: AsyncSession = Depends(get_db)):
     """
     获取特定仓库的详细信息，包括所有发布版本
     """
-    repo = db.query(Repository).filter(Repository.id == repo_id).first()
+    repo = await db.scalar(
+        select(Repository)
+        .options(
+            selectinload(Repository.releases).options(
+                selectinload(Release.assets),
+                joinedload(Release.author),
+            )
+        )
+        .where(Repository.id == repo_id)
+    )
     if not repo:
         raise HTTPException(status_code=404, detail="Repository not found")
     return RepositoryModel(
             id=repo.id,
             name=repo.name,
-            plugin=json.loads(repo.plugin),
+            plugin=_parse_plugin(repo),
             full_name=repo.full_name,
             html_url=repo.html_url,
             releases=repo.releases, 
         )
 
 @app.get("/releases/{release_id}", response_model=ReleaseModel, tags=["Releases"])
-async def get_release(release_id: int, db: Session = Depends(get_db)):
+@cache(expire=60)
+async def get_release(release_id: int, db: AsyncSession = Depends(get_db)):
     """
     获取特定发布版本的详细信息
     """
-    release = db.query(Release).filter(Release.id == release_id).first()
+    release = await db.scalar(
+        select(Release)
+        .options(selectinload(Release.assets), joinedload(Release.author))
+        .where(Release.id == release_id)
+    )
     if not release:
         raise HTTPException(status_code=404, detail="Release not found")
     return release
 
 @app.get("/releases/{release_id}/assets", response_model=List[AssetModel], tags=["Assets"])
+@cache(expire=60)
 async def get_release_assets(
     release_id: int, 
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """
     获取特定发布版本的所有资源文件
     """
-    release = db.query(Release).filter(Release.id == release_id).first()
+    release = await db.get(Release, release_id)
     if not release:
         raise HTTPException(status_code=404, detail="Release not found")
     
-    assets = db.query(Asset).filter(Asset.release_id == release_id).all()
+    result = await db.execute(select(Asset).where(Asset.release_id == release_id))
+    assets = result.scalars().all()
     return assets
 
 @app.get("/assets/{asset_id}", response_model=AssetModel, tags=["Assets"])
-async def get_asset(asset_id: int, db: Session = Depends(get_db)):
+@cache(expire=60)
+async def get_asset(asset_id: int, db: AsyncSession = Depends(get_db)):
     """
     获取特定资源文件的详细信息
     """
-    asset = db.query(Asset).filter(Asset.id == asset_id).first()
+    asset = await db.get(Asset, asset_id)
     if not asset:
         raise HTTPException(status_code=404, detail="Asset not found")
     return asset
 
 @app.get("/authors", response_model=List[AuthorModel], tags=["Authors"])
+@cache(expire=60)
 async def get_authors(
     skip: int = 0, 
     limit: int = 100,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """
     获取所有作者信息
     """
-    authors = db.query(Author).offset(skip).limit(limit).all()
+    result = await db.execute(select(Author).offset(skip).limit(limit))
+    authors = result.scalars().all()
     return authors
 
 @app.get("/authors/{author_id}", response_model=AuthorModel, tags=["Authors"])
-async def get_author(author_id: int, db: Session = Depends(get_db)):
+@cache(expire=60)
+async def get_author(author_id: int, db: AsyncSession = Depends(get_db)):
     """
     获取特定作者的详细信息
     """
-    author = db.query(Author).filter(Author.id == author_id).first()
+    author = await db.get(Author, author_id)
     if not author:
         raise HTTPException(status_code=404, detail="Author not found")
     return author
 
-@app.get("/search/repositories", response_model=List[RepositoryBasicModel], tags=["Search"])
+@app.get("/search/repositories", response_model=List[RepositorySearchModel], tags=["Search"])
+@cache(expire=60)
 async def search_repositories(
     q: str = Query(..., description="搜索关键词"),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """
     搜索仓库
     """
     search_term = f"%{q}%"
-    repositories = db.query(Repository).filter(
-        Repository.name.like(search_term) | Repository.full_name.like(search_term)
-    ).all()
+    result = await db.execute(
+        select(Repository, func.count(Release.id))
+        .outerjoin(Release, Release.repository_id == Repository.id)
+        .where(Repository.name.like(search_term) | Repository.full_name.like(search_term))
+        .group_by(Repository.id)
+    )
+    rows = result.all()
     
     result = []
-    for repo in repositories:
-        release_count = db.query(Release).filter(Release.repository_id == repo.id).count()
-        repo_model = RepositoryBasicModel(
+    for repo, release_count in rows:
+        repo_model = RepositorySearchModel(
             id=repo.id,
             name=repo.name,
+            plugin=_parse_plugin(repo),
             full_name=repo.full_name,
             html_url=repo.html_url,
             release_count=release_count
@@ -1,18 +1,39 @@
 import json
 import requests
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, ForeignKey, Text, BigInteger
+from requests.adapters import HTTPAdapter
+from sqlalchemy import create_engine, event, func, inspect, text, Column, Integer, String, DateTime, Boolean, ForeignKey, Text, BigInteger, Index
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import relationship, sessionmaker,declarative_base,Session
 from datetime import datetime
+from urllib3.util import Retry
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 # 创建SQLAlchemy基类
 Base = declarative_base()
 
 db_file = "github_releases.sqlite"
+# 文件型SQLite默认使用QueuePool且允许跨线程使用连接，配合WAL即可并发读写
 engine = create_engine(f'sqlite:///{db_file}')
 
 
 get_session = sessionmaker(bind=engine)
+# 供API读取使用的异步引擎，避免查询阻塞事件循环
+async_engine = create_async_engine(f'sqlite+aiosqlite:///{db_file}')
+get_async_session = async_sessionmaker(bind=async_engine, class_=AsyncSession, expire_on_commit=False)
+
+# 每个新连接启用WAL等优化参数，使读写可以并发进行
+@event.listens_for(engine, "connect")
+@event.listens_for(async_engine.sync_engine, "connect")
+def _set_sqlite_pragma(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.close()
 # 定义数据库模型
 class Repository(Base):
     __tablename__ = 'repositories'
@@ -22,6 +43,8 @@ class Repository(Base):
     full_name = Column(String(200), nullable=False, unique=True)
     html_url = Column(String(255), nullable=False)
     plugin = Column(Text, nullable=True)
+    # plugin内容每次变化时递增，用作解析结果缓存的版本号
+    plugin_version = Column(Integer, nullable=False, default=0, server_default='0')
     # 与Release的关系
     releases = relationship("Release", back_populates="repository", cascade="all, delete-orphan")
     
@@ -30,11 +53,15 @@ class Repository(Base):
 
 class Release(Base):
     __tablename__ = 'releases'
+    # (repository_id, tag_name)联合索引同时覆盖按仓库过滤和tag_name列表查询
+    __table_args__ = (
+        Index('ix_releases_repository_id_tag_name', 'repository_id', 'tag_name'),
+    )
     
     id = Column(Integer, primary_key=True)
     github_id = Column(Integer, unique=True)
     repository_id = Column(Integer, ForeignKey('repositories.id'))
-    author_id = Column(Integer, ForeignKey('authors.id'), nullable=True)
+    author_id = Column(Integer, ForeignKey('authors.id'), nullable=True, index=True)
     tag_name = Column(String(100))
     name = Column(String(255))
     body = Column(Text)
@@ -61,8 +88,8 @@ class Asset(Base):
     
     id = Column(Integer, primary_key=True)
     github_id = Column(Integer, unique=True)
-    release_id = Column(Integer, ForeignKey('releases.id'))
-    uploader_id = Column(Integer, ForeignKey('authors.id'), nullable=True)
+    release_id = Column(Integer, ForeignKey('releases.id'), index=True)
+    uploader_id = Column(Integer, ForeignKey('authors.id'), nullable=True, index=True)
     name = Column(String(255))
     label = Column(String(255), nullable=True)
     content_type = Column(String(100))
@@ -94,20 +121,43 @@ class Author(Base):
     def __repr__(self):
         return f"<Author(login='{self.login}', github_id={self.github_id})>"
 
-# 创建或获取Author
-def get_or_create_author(session:Session, author_data):
-    author = session.query(Author).filter_by(github_id=author_data['id']).first()
-    if not author:
-        author = Author(
-            github_id=author_data['id'],
-            login=author_data['login'],
-            avatar_url=author_data['avatar_url'],
-            html_url=author_data['html_url'],
-            type=author_data['type']
-        )
-        session.add(author)
-        session.flush()
-    return author
+# 批量写入Author(UPSERT)，返回github_id到数据库id的映射
+def upsert_authors(session:Session, authors_data):
+    rows = {
+        author_data['id']: {
+            'github_id': author_data['id'],
+            'login': author_data['login'],
+            'avatar_url': author_data['avatar_url'],
+            'html_url': author_data['html_url'],
+            'type': author_data['type'],
+        }
+        for author_data in authors_data
+    }
+    if not rows:
+        return {}
+    stmt = sqlite_insert(Author).values(list(rows.values()))
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Author.github_id],
+        set_={
+            'login': stmt.excluded.login,
+            'avatar_url': stmt.excluded.avatar_url,
+            'html_url': stmt.excluded.html_url,
+            'type': stmt.excluded.type,
+        }
+    )
+    return dict(session.execute(stmt.returning(Author.github_id, Author.id)).all())
+
+# 复用同一个HTTP会话，避免每次请求重新建立TCP+TLS连接
+_http = requests.Session()
+_http.mount('https://', HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504], raise_on_status=False),
+))
+
+# 解析GitHub返回的UTC时间(如2024-01-01T00:00:00Z)，结果与原strptime一致为naive datetime
+def _parse_ts(value):
+    return datetime.fromisoformat(value.removesuffix('Z')) if value else None
 
 # 获取GitHub仓库的releases
 def fetch_github_releases(repo_owner, repo_name, token=None):
@@ -116,7 +166,7 @@ def fetch_github_releases(repo_owner, repo_name, token=None):
         headers['Authorization'] = f'token {token}'
     
     url = f'https://api.github.com/repos/{repo_owner}/{repo_name}/releases'
-    response = requests.get(url, headers=headers)
+    response = _http.get(url, headers=headers, timeout=10)
     if response.status_code == 200:
         return response.json()
     else:
@@ -130,150 +180,184 @@ def plugin_json_exists(release_data):
             return True
     return False
 
+PLUGIN_JSON_MAX_SIZE = 25 << 20
+
 def plugin_json_download(browser_download_url):
     headers = {}
     # if token:
     #     headers['Authorization'] = f'token {token}'
      
-    response = requests.get(browser_download_url, headers=headers)
-    if response.status_code == 200:
-        return response.text
+    # 分块流式读取，超过大小上限直接放弃，避免异常文件占满内存
+    with _http.get(browser_download_url, headers=headers, stream=True, timeout=30) as response:
+        if response.status_code != 200:
+            print(f"Error fetching {browser_download_url}: {response.status_code}")
+            return None
+        buf = bytearray()
+        for chunk in response.iter_content(65536):
+            buf += chunk
+            if len(buf) > PLUGIN_JSON_MAX_SIZE:
+                print(f"Error fetching {browser_download_url}: larger than {PLUGIN_JSON_MAX_SIZE} bytes")
+                return None
+    try:
+        # utf-8-sig去除可能存在的BOM，否则后续JSON解析会失败
+        return buf.decode('utf-8-sig')
+    except UnicodeDecodeError as e:
+        print(f"Error fetching {browser_download_url}: {e}")
+        return None
+
+# 获取GitHub仓库信息
+def fetch_github_repository(repo_owner, repo_name):
+    repo_url = f'https://api.github.com/repos/{repo_owner}/{repo_name}'
+    repo_response = _http.get(repo_url, timeout=10)
+    if repo_response.status_code == 200:
+        return repo_response.json()
     else:
-        print(f"Error fetching {browser_download_url}: {response.status_code}")
+        print(f"Error fetching repository info: {repo_response.status_code}")
         return None
 
+# 下载结果已不再需要时，仍输出下载过程中的异常
+def _report_download_error(future):
+    error = future.exception()
+    if error is not None:
+        print(f"Error fetching plugin.json: {error}")
+
 # 将GitHub release数据保存到数据库
 def save_releases_to_db(repo_owner, repo_name, releases_data=None):
-    first = True
     if releases_data is None:
         releases_data = fetch_github_releases(repo_owner,repo_name)
+    releases_data = [release_data for release_data in releases_data if plugin_json_exists(release_data)]
+    # 第一个plugin.json作为仓库的插件信息
+    plugin_json_url = next(
+        (
+            asset_data['browser_download_url']
+            for release_data in releases_data
+            for asset_data in release_data['assets']
+            if asset_data['name'] == "plugin.json"
+        ),
+        None
+    )
     with get_session() as session:
         repo = session.query(Repository).filter_by(full_name=f"{repo_owner}/{repo_name}").first()
+        # 写库前先完成下载，避免下载期间一直持有SQLite写锁
+        plugin_json_str: str | None = None
         if not repo:
-            # 获取仓库信息
-            repo_url = f'https://api.github.com/repos/{repo_owner}/{repo_name}'
-            repo_response = requests.get(repo_url)
-            if repo_response.status_code == 200:
-                repo_data = repo_response.json()
-                repo = Repository(
-                    id=repo_data['id'],
-                    name=repo_data['name'],
-                    full_name=repo_data['full_name'],
-                    html_url=repo_data['html_url']
-                )
-                session.add(repo)
-                session.flush()
-            else:
-                print(f"Error fetching repository info: {repo_response.status_code}")
+            # 新仓库需要获取仓库信息，plugin.json在后台线程同时下载
+            plugin_json_future = None
+            if plugin_json_url:
+                executor = ThreadPoolExecutor(max_workers=1)
+                plugin_json_future = executor.submit(plugin_json_download, plugin_json_url)
+                # 立即shutdown(wait=False)，提前返回时无需等待下载完成
+                executor.shutdown(wait=False)
+            repo_data = fetch_github_repository(repo_owner, repo_name)
+            if repo_data is None:
+                if plugin_json_future:
+                    plugin_json_future.add_done_callback(_report_download_error)
                 return
+            if plugin_json_future:
+                plugin_json_str = plugin_json_future.result()
+            repo = Repository(
+                id=repo_data['id'],
+                name=repo_data['name'],
+                full_name=repo_data['full_name'],
+                html_url=repo_data['html_url']
+            )
+            session.add(repo)
+            session.flush()
+        elif plugin_json_url:
+            plugin_json_str = plugin_json_download(plugin_json_url)
         
+        # 预先批量处理所有作者及上传者
+        authors_data = []
         for release_data in releases_data:
-            if not plugin_json_exists(release_data):
-                continue
-            author = None
-            if 'author' in release_data and release_data['author']:
-                author = get_or_create_author(session, release_data['author'])
-            
-            # 检查release是否已存在
-            release = session.query(Release).filter_by(github_id=release_data['id']).first()
-            if not release:
-                # 创建新release
-                release = Release(
-                    github_id=release_data['id'],
-                    repository_id=repo.id,
-                    author_id=author.id if author else None,
-                    tag_name=release_data['tag_name'],
-                    name=release_data['name'],
-                    body=release_data['body'],
-                    draft=release_data['draft'],
-                    prerelease=release_data['prerelease'],
-                    created_at=datetime.strptime(release_data['created_at'], '%Y-%m-%dT%H:%M:%SZ'),
-                    published_at=datetime.strptime(release_data['published_at'], '%Y-%m-%dT%H:%M:%SZ') if release_data['published_at'] else None,
-                    html_url=release_data['html_url'],
-                    tarball_url=release_data['tarball_url'],
-                    zipball_url=release_data['zipball_url']
-                )
-                session.add(release)
-                session.flush()
-                
-                # 处理assets
-                for asset_data in release_data['assets']:
-                    if first and asset_data['name'] == "plugin.json":
-                        plugin_json_str: str | None = plugin_json_download(asset_data['browser_download_url'])
-                        repo.plugin = plugin_json_str
-                        session.flush()
-                        first = False
-                    # 处理asset上传者信息
-                    uploader = None
-                    if 'uploader' in asset_data and asset_data['uploader']:
-                        uploader = get_or_create_author(session, asset_data['uploader'])
-                    
-                    asset = Asset(
-                        github_id=asset_data['id'],
-                        release_id=release.id,
-                        uploader_id=uploader.id if uploader else None,
-                        name=asset_data['name'],
-                        label=asset_data['label'],
-                        content_type=asset_data['content_type'],
-                        state=asset_data['state'],
-                        size=asset_data['size'],
-                        download_count=asset_data['download_count'],
-                        created_at=datetime.strptime(asset_data['created_at'], '%Y-%m-%dT%H:%M:%SZ'),
-                        updated_at=datetime.strptime(asset_data['updated_at'], '%Y-%m-%dT%H:%M:%SZ'),
-                        browser_download_url=asset_data['browser_download_url']
-                    )
-                    session.add(asset)
-            else:
-                # 更新已存在的release
-                release.tag_name = release_data['tag_name']
-                release.name = release_data['name']
-                release.body = release_data['body']
-                release.draft = release_data['draft']
-                release.prerelease = release_data['prerelease']
-                if author:
-                    release.author_id = author.id
-                
-                # 更新assets
-                for asset_data in release_data['assets']:
-                    if first and asset_data['name'] == "plugin.json":
-                        plugin_json_str: str | None = plugin_json_download(asset_data['browser_download_url'])
-                        repo.plugin = plugin_json_str
-                        session.flush()
-                        first = False
-                    asset = session.query(Asset).filter_by(github_id=asset_data['id']).first()
-                    if not asset:
-                        # 处理asset上传者信息
-                        uploader = None
-                        if 'uploader' in asset_data and asset_data['uploader']:
-                            uploader = get_or_create_author(session, asset_data['uploader'])
-                        
-                        # 创建新asset
-                        asset = Asset(
-                            github_id=asset_data['id'],
-                            release_id=release.id,
-                            uploader_id=uploader.id if uploader else None,
-                            name=asset_data['name'],
-                            label=asset_data['label'],
-                            content_type=asset_data['content_type'],
-                            state=asset_data['state'],
-                            size=asset_data['size'],
-                            download_count=asset_data['download_count'],
-                            created_at=datetime.strptime(asset_data['created_at'], '%Y-%m-%dT%H:%M:%SZ'),
-                            updated_at=datetime.strptime(asset_data['updated_at'], '%Y-%m-%dT%H:%M:%SZ'),
-                            browser_download_url=asset_data['browser_download_url']
-                        )
-                        session.add(asset)
-                    else:
-                        # 更新已存在的asset
-                        asset.name = asset_data['name']
-                        asset.label = asset_data['label']
-                        asset.state = asset_data['state']
-                        asset.download_count = asset_data['download_count']
-                        asset.updated_at = datetime.strptime(asset_data['updated_at'], '%Y-%m-%dT%H:%M:%SZ')
+            if release_data.get('author'):
+                authors_data.append(release_data['author'])
+            for asset_data in release_data['assets']:
+                if asset_data.get('uploader'):
+                    authors_data.append(asset_data['uploader'])
+        author_ids = upsert_authors(session, authors_data)
+
+        if not releases_data:
+            session.commit()
+            return
+
+        # 批量写入releases，已存在的按github_id更新
+        stmt = sqlite_insert(Release).values([
+            {
+                'github_id': release_data['id'],
+                'repository_id': repo.id,
+                'author_id': author_ids[release_data['author']['id']] if release_data.get('author') else None,
+                'tag_name': release_data['tag_name'],
+                'name': release_data['name'],
+                'body': release_data['body'],
+                'draft': release_data['draft'],
+                'prerelease': release_data['prerelease'],
+                'created_at': _parse_ts(release_data['created_at']),
+                'published_at': _parse_ts(release_data['published_at']),
+                'html_url': release_data['html_url'],
+                'tarball_url': release_data['tarball_url'],
+                'zipball_url': release_data['zipball_url'],
+            }
+            for release_data in releases_data
+        ])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Release.github_id],
+            set_={
+                'tag_name': stmt.excluded.tag_name,
+                'name': stmt.excluded.name,
+                'body': stmt.excluded.body,
+                'draft': stmt.excluded.draft,
+                'prerelease': stmt.excluded.prerelease,
+                'author_id': func.coalesce(stmt.excluded.author_id, Release.author_id),
+            }
+        )
+        release_ids = dict(session.execute(stmt.returning(Release.github_id, Release.id)).all())
+
+        # 批量写入assets，已存在的按github_id更新
+        asset_rows = []
+        for release_data in releases_data:
+            for asset_data in release_data['assets']:
+                asset_rows.append({
+                    'github_id': asset_data['id'],
+                    'release_id': release_ids[release_data['id']],
+                    'uploader_id': author_ids[asset_data['uploader']['id']] if asset_data.get('uploader') else None,
+                    'name': asset_data['name'],
+                    'label': asset_data['label'],
+                    'content_type': asset_data['content_type'],
+                    'state': asset_data['state'],
+                    'size': asset_data['size'],
+                    'download_count': asset_data['download_count'],
+                    'created_at': _parse_ts(asset_data['created_at']),
+                    'updated_at': _parse_ts(asset_data['updated_at']),
+                    'browser_download_url': asset_data['browser_download_url'],
+                })
+        stmt = sqlite_insert(Asset).values(asset_rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Asset.github_id],
+            set_={
+                'name': stmt.excluded.name,
+                'label': stmt.excluded.label,
+                'state': stmt.excluded.state,
+                'download_count': stmt.excluded.download_count,
+                'updated_at': stmt.excluded.updated_at,
+            }
+        )
+        session.execute(stmt)
 
         # 加载最新的plugin.json到数据库
+        if plugin_json_url:
+            if repo.plugin != plugin_json_str:
+                repo.plugin = plugin_json_str
+                repo.plugin_version = (repo.plugin_version or 0) + 1
         session.commit()
 Base.metadata.create_all(engine)
+# create_all不会为已存在的表补充新列，旧数据库在此补上plugin_version
+with engine.begin() as connection:
+    if 'plugin_version' not in {column['name'] for column in inspect(connection).get_columns('repositories')}:
+        connection.execute(text("ALTER TABLE repositories ADD COLUMN plugin_version INTEGER NOT NULL DEFAULT 0"))
+# create_all不会为已存在的表补建索引，这里逐个检查并创建
+for table in Base.metadata.sorted_tables:
+    for index in table.indexes:
+        index.create(engine, checkfirst=True)
 
 if __name__ == '__main__':
     save_releases_to_db("kitUIN","ShadowViewer.Plugin.Bika")
\ No newline at end of file
@@ -62,5 +62,8 @@ class RepositoryBasicModel(BaseModel):
     plugin: Dict
     releases: List[str] = []
 
+class RepositorySearchModel(RepositoryBasicModel):
+    release_count: int = 0
+
 class RepositoryModel(RepositoryBasicModel): 
     releases: List[ReleaseModel] = []
\ No newline at end of file